@@ -1,62 +1,148 @@
 import streamlit as st
-import pandas as pd
 import numpy as np
 import os
+import mimetypes
+import html
+from urllib.parse import urlparse
 import traceback
-import base64
+import hashlib
 from io import BytesIO
+from pathlib import Path
+import pyarrow as pa
+import pyarrow.csv as pacsv
 import requests
-from firebase_utils import initialize_firebase, match_minutiae_with_database
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
+from firebase_utils import (
+    REFERENCE_CACHE_TTL,
+    initialize_firebase,
+    invalidate_reference_cache,
+    match_minutiae_with_database
+)
+
+# Read the page icon once per server process; raw bytes are passed through without re-encoding
+@st.cache_resource(show_spinner=False)
+def load_page_icon():
+    return Path("static/IAFISt.png").read_bytes()
 
 # Set up page configuration
 st.set_page_config(
     page_title="IAFIS",
-    page_icon="IAFISt.png",
+    page_icon=load_page_icon(),
     layout="centered"
 )
 
+# Initialize Firebase once per server process and share the clients across sessions
+@st.cache_resource(show_spinner=False)
+def get_firebase_clients():
+    return initialize_firebase()
+
 # Initialize Firebase at startup
 try:
-    db, bucket = initialize_firebase()
+    db, bucket = get_firebase_clients()
     firebase_initialized = True
 except Exception as e:
     st.error(f"Error initializing Firebase: {str(e)}")
     firebase_initialized = False
     st.write("Please check your serviceAccountKey.json file and Firebase setup.")
 
+# Number of images fetched at once, and connections kept open per host to serve them
+IMAGE_FETCH_WORKERS = 8
+
+# Shared HTTP session so connections are reused across image fetches
+@st.cache_resource
+def get_http_session():
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=IMAGE_FETCH_WORKERS)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    # Images are already compressed, so ask for the raw bytes
+    session.headers["Accept-Encoding"] = "identity"
+    return session
+
+# Function to fetch image bytes from URL, cached across reruns
+@st.cache_data(ttl=3600, show_spinner=False)
+def fetch_image_bytes(image_url):
+    # Stream the response so the body is read straight into a single buffer
+    with get_http_session().get(image_url, stream=True, timeout=(3, 10)) as response:
+        response.raise_for_status()
+        response.raw.decode_content = True
+        return response.raw.read()
+
+# Storage hosts that serve public images the browser can load directly
+PUBLIC_IMAGE_HOSTS = {"storage.googleapis.com", "firebasestorage.googleapis.com"}
+
+# Function to check whether an image URL can be handed to the browser as is
+def is_public_image_url(image_url):
+    parsed = urlparse(image_url)
+    return parsed.scheme == "https" and parsed.hostname in PUBLIC_IMAGE_HOSTS
+
+# Function to fetch several images concurrently, returning the bytes keyed by URL
+def prefetch_images(image_urls):
+    def fetch(image_url):
+        try:
+            return fetch_image_bytes(image_url)
+        except Exception:
+            # Failed images are fetched (and reported) again when displayed
+            return None
+    
+    with ThreadPoolExecutor(max_workers=IMAGE_FETCH_WORKERS) as executor:
+        results = list(executor.map(fetch, image_urls))
+    
+    return {url: data for url, data in zip(image_urls, results) if data is not None}
+
+# Function to collect the distinct suspect image URLs of a list of matches
+def get_suspect_image_urls(matches):
+    # A set, so a suspect that appears in several matches is only fetched once
+    urls = set()
+    for match in matches:
+        assignment_data = match['matchData'].get('assignmentData') or {}
+        image_url = assignment_data.get('suspectImageUrl')
+        # Public images are loaded by the browser, so only gated ones need fetching
+        if image_url and not is_public_image_url(image_url):
+            urls.add(image_url)
+    return list(urls)
+
 # Function to fetch and display image from URL
-def display_image_from_url(image_url, caption=""):
+def display_image_from_url(image_url, caption="", image_data=None):
     try:
-        # Fetch the image data
-        response = requests.get(image_url)
-        if response.status_code == 200:
-            # Get the image data and content type
-            image_data = response.content
-            
-            # Display the image
-            st.image(image_data, caption=caption, use_container_width=True)
-            
-            # Return the data for potential download
-            return image_data
-        else:
-            st.warning(f"Failed to load image: HTTP {response.status_code}")
-            return None
+        # Fetch the image data unless it was prefetched (served from cache on reruns)
+        if image_data is None:
+            image_data = fetch_image_bytes(image_url)
+        
+        # Display the image
+        st.image(image_data, caption=caption, use_container_width=True)
+        
+        # Return the data for potential download
+        return image_data
+    except requests.HTTPError as e:
+        st.warning(f"Failed to load image: HTTP {e.response.status_code}")
+        return None
     except Exception as e:
         st.warning(f"Error loading image: {str(e)}")
         st.write(f"Image URL: {image_url}")
         return None
 
-# Function to create a download link for images
-def get_image_download_link(img_data, filename="fingerprint.jpg"):
+# Function to parse the uploaded minutiae CSV, cached on the file contents
+@st.cache_data(show_spinner=False)
+def parse_minutiae_csv(raw_bytes):
+    # The CSV has no headers, so let pyarrow name the columns f0, f1, ...
+    read_options = pacsv.ReadOptions(autogenerate_column_names=True)
     try:
-        b64 = base64.b64encode(img_data).decode()
-        href = f'<a href="data:image/jpeg;base64,{b64}" download="{filename}">Download Image</a>'
-        return href
-    except Exception as e:
-        return f"Error creating download link: {str(e)}"
+        table = pacsv.read_csv(
+            BytesIO(raw_bytes),
+            read_options=read_options,
+            convert_options=pacsv.ConvertOptions(column_types={f"f{i}": pa.float32() for i in range(4)})
+        )
+    except pa.ArrowInvalid:
+        # Some columns hold text (e.g. type labels), so keep the inferred types and let the matcher coerce them
+        table = pacsv.read_csv(BytesIO(raw_bytes), read_options=read_options)
+    df = table.to_pandas()
+    df.columns = range(len(df.columns))
+    return df
 
 # Function to display match information
-def display_match_info(match_data, similarity):
+def display_match_info(match_data, similarity, image_cache=None, key="match"):
     # Display match confidence
     st.metric("Match Confidence", f"{similarity['score']:.2f}%")
     
@@ -90,24 +176,112 @@ def display_match_info(match_data, similarity):
         
         # Display the image
         st.subheader("Suspect Image")
-        img_data = display_image_from_url(image_url, "Suspect Image")
+        suspect_id = match_data['assignmentData'].get('suspectId', 'suspect')
+        # Get file extension from URL path, default to jpg
+        file_ext = os.path.splitext(urlparse(image_url).path)[1]
+        if not file_ext:
+            file_ext = ".jpg"
+        file_name = f"{suspect_id}{file_ext}"
         
-        # Add download button if image was loaded
-        if img_data:
-            suspect_id = match_data['assignmentData'].get('suspectId', 'suspect')
-            # Get file extension from URL, default to jpg
-            file_ext = os.path.splitext(image_url)[1]
-            if not file_ext:
-                file_ext = ".jpg"
-            download_link = get_image_download_link(img_data, f"{suspect_id}{file_ext}")
-            st.markdown(download_link, unsafe_allow_html=True)
-    
-    
+        if is_public_image_url(image_url):
+            # Let the browser load public images directly instead of relaying them through the server
+            st.image(image_url, caption="Suspect Image", use_container_width=True)
+            st.markdown(
+                f'<a href="{html.escape(image_url)}" download="{html.escape(file_name)}" target="_blank">Download Image</a>',
+                unsafe_allow_html=True
+            )
+        else:
+            img_data = display_image_from_url(image_url, "Suspect Image", (image_cache or {}).get(image_url))
+        
+            # Add download button if image was loaded
+            if img_data:
+                st.download_button(
+                    "Download Image",
+                    data=img_data,
+                    file_name=file_name,
+                    mime=mimetypes.guess_type(file_name)[0] or "image/jpeg",
+                    key=f"dl_{key}",
+                    # Downloading doesn't change any state, so don't rerun on click
+                    on_click="ignore"
+                )
+
+# Function to display the result of a database match. Runs as a fragment so that
+# widgets inside it only rerun this function, not the whole script.
+@st.fragment
+def display_match_result(result):
+    if result and 'match' in result and result['match']:
+        # Check if we have multiple perfect matches
+        if 'perfectMatches' in result and len(result['perfectMatches']) > 1:
+            perfect_matches = result['perfectMatches']
+            st.success(f"Found {len(perfect_matches)} perfect matches!")
+
+            # Download all suspect images up front instead of one per tab
+            image_cache = prefetch_images(get_suspect_image_urls(perfect_matches))
+
+            # Create tabs for each perfect match
+            labels = [m['matchData']['studentInfo']['id'] for m in perfect_matches]
+            items = [(m['id'], m['matchData'], m['similarity']) for m in perfect_matches]
+            tabs = st.tabs([f"Match {i+1}: {label}" for i, label in enumerate(labels)])
+
+            # Display each match in its own tab
+            for tab, (match_id, match_data, similarity) in zip(tabs, items):
+                with tab:
+                    display_match_info(match_data, similarity, image_cache, key=match_id)
+
+            # Add debug info if requested
+            if st.checkbox("Show match details"):
+                st.write("### Match Details")
+                for i, match in enumerate(perfect_matches):
+                    st.write(f"**Match {i+1}**: {match['id']}")
+                    st.write(f"Score: {match['similarity']['score']:.2f}%")
+                    st.write(f"Matched Points: {match['similarity']['matchedPoints']}/{match['similarity']['totalPoints']}")
+
+        else:
+            # Single match case
+            st.success("Match found!")
+            display_match_info(result['match'], result['similarity'])
+
+    elif result and 'goodMatches' in result and result['goodMatches']:
+        # Show good matches
+        good_matches = result['goodMatches']
+        st.success(f"Found {len(good_matches)} good matches!")
+
+        # Download all suspect images up front instead of one per tab
+        image_cache = prefetch_images(get_suspect_image_urls(good_matches))
+
+        # Create tabs for each good match
+        labels = [m['matchData']['studentInfo']['id'] for m in good_matches]
+        items = [(m['id'], m['matchData'], m['similarity']) for m in good_matches]
+        tabs = st.tabs([f"Match {i+1}: {label}" for i, label in enumerate(labels)])
+
+        # Display each match in its own tab
+        for tab, (match_id, match_data, similarity) in zip(tabs, items):
+            with tab:
+                display_match_info(match_data, similarity, image_cache, key=match_id)
+
+    elif result and 'closestMatch' in result:
+        # Show closest match that's below threshold
+        closest = result['closestMatch']
+
+        st.warning("No exact match found, but here's the closest one:")
+        st.metric("Match Confidence", f"{closest['similarity']['score']:.2f}%")
+        st.write(f"Matched {closest['similarity']['matchedPoints']} out of {closest['similarity']['totalPoints']} minutiae points")
+
+        # Show match details
+        display_match_info(closest['matchData'], closest['similarity'], key=closest['id'])
+    else:
+        st.error("No match found. Please check your data and try again.")
+
+# Function to match the uploaded CSV against the database, cached on the file contents
+@st.cache_data(ttl=600, show_spinner=False)
+def match_fingerprint(raw_bytes):
+    return match_minutiae_with_database(parse_minutiae_csv(raw_bytes))
 
 # App title and description
 left_co,cent_co,last_co = st.columns(3)
 with cent_co:
-    st.image("IAFISt.png",width=210,)
+    # Served by Streamlit's static file server so the browser can cache it
+    st.markdown('<img src="app/static/IAFISt.png" width="210">', unsafe_allow_html=True)
 st.markdown("<h1 style='text-align: center; color: grey;'>Integrated Automated Fingerprint Identification System</h1>", unsafe_allow_html=True)
 st.markdown("<h2 style='text-align: center; color: grey;'>Federal Bureau of Investigation</h2>", unsafe_allow_html=True)
 st.subheader("Image Processing and Computer Vision Worksheet 3A Criminal Database")
@@ -122,83 +296,48 @@ uploaded_file = st.file_uploader("Upload your minutiae CSV file", type=["csv"])
 if uploaded_file is not None:
     # Display the uploaded file as a dataframe
     try:
-        # Explicitly set header=None to indicate there are no headers in the CSV
-        df = pd.read_csv(uploaded_file, header=None)
+        csv_bytes = uploaded_file.getvalue()
+        csv_key = hashlib.blake2b(csv_bytes, digest_size=16).hexdigest()
+        df = parse_minutiae_csv(csv_bytes)
         
         # Show preview
         st.write("Preview of uploaded data:")
         st.dataframe(df.head())
         
-        # Match the minutiae with the database
-        if st.button("Find Match"):
-            if not firebase_initialized:
-                st.error("Cannot match data because Firebase is not initialized.")
-            else:
-                with st.spinner("Matching fingerprint..."):
-                    try:
-                        # Try to match with database
-                        result = match_minutiae_with_database(df)
-                        
-                        if result and 'match' in result and result['match']:
-                            # Check if we have multiple perfect matches
-                            if 'perfectMatches' in result and len(result['perfectMatches']) > 1:
-                                st.success(f"Found {len(result['perfectMatches'])} perfect matches!")
-                                
-                                # Create tabs for each perfect match
-                                tabs = st.tabs([f"Match {i+1}: {m['matchData']['studentInfo']['id']}" 
-                                               for i, m in enumerate(result['perfectMatches'])])
-                                
-                                # Display each match in its own tab
-                                for i, (tab, match) in enumerate(zip(tabs, result['perfectMatches'])):
-                                    with tab:
-                                        display_match_info(match['matchData'], match['similarity'])
-                                
-                                # Add debug info if requested
-                                if st.checkbox("Show match details"):
-                                    st.write("### Match Details")
-                                    for i, match in enumerate(result['perfectMatches']):
-                                        st.write(f"**Match {i+1}**: {match['id']}")
-                                        st.write(f"Score: {match['similarity']['score']:.2f}%")
-                                        st.write(f"Matched Points: {match['similarity']['matchedPoints']}/{match['similarity']['totalPoints']}")
-                                    
-                            else:
-                                # Single match case
-                                st.success("Match found!")
-                                display_match_info(result['match'], result['similarity'])
-                        
-                        elif result and 'goodMatches' in result and result['goodMatches']:
-                            # Show good matches
-                            st.success(f"Found {len(result['goodMatches'])} good matches!")
-                            
-                            # Create tabs for each good match
-                            tabs = st.tabs([f"Match {i+1}: {m['matchData']['studentInfo']['id']}" 
-                                           for i, m in enumerate(result['goodMatches'])])
-                            
-                            # Display each match in its own tab
-                            for i, (tab, match) in enumerate(zip(tabs, result['goodMatches'])):
-                                with tab:
-                                    display_match_info(match['matchData'], match['similarity'])
-                        
-                        elif result and 'closestMatch' in result:
-                            # Show closest match that's below threshold
-                            closest = result['closestMatch']
-                            
-                            st.warning("No exact match found, but here's the closest one:")
-                            st.metric("Match Confidence", f"{closest['similarity']['score']:.2f}%")
-                            st.write(f"Matched {closest['similarity']['matchedPoints']} out of {closest['similarity']['totalPoints']} minutiae points")
-                            
-                            # Show match details
-                            display_match_info(closest['matchData'], closest['similarity'])
-                        else:
-                            st.error("No match found. Please check your data and try again.")
-                    
-                    except Exception as e:
-                        st.error(f"Error during matching: {str(e)}")
-                        st.write("Please try again or contact your instructor for assistance.")
-                        
-                        # Show detailed error in debug mode
-                        if st.checkbox("Show detailed error"):
-                            st.code(traceback.format_exc())
+        try:
+            # Reuse the stored result if this file has already been matched
+            has_result = st.session_state.get('match_key') == csv_key
+            
+            # The reference fingerprints are cached, so say how fresh results are
+            st.caption(
+                f"Reference fingerprints are refreshed every {REFERENCE_CACHE_TTL // 60} minutes, so fingerprints "
+                "enrolled more recently may not be matched yet. Re-running a match always checks the latest references."
+            )
+            
+            # Match the minutiae with the database
+            if st.button("Re-run match" if has_result else "Find Match"):
+                if not firebase_initialized:
+                    st.error("Cannot match data because Firebase is not initialized.")
+                else:
+                    if has_result:
+                        # Drop cached results so the database is queried again
+                        match_fingerprint.clear()
+                        invalidate_reference_cache()
+                    with st.spinner("Matching fingerprint..."):
+                        st.session_state['match_result'] = match_fingerprint(csv_bytes)
+                        st.session_state['match_key'] = csv_key
+            
+            # Render the stored result from memory so other widgets don't re-run the match
+            if st.session_state.get('match_key') == csv_key:
+                display_match_result(st.session_state['match_result'])
+        
+        except Exception as e:
+            st.error(f"Error during matching: {str(e)}")
+            st.write("Please try again or contact your instructor for assistance.")
+            
+            # Show detailed error in debug mode
+            if st.checkbox("Show detailed error"):
+                st.code(traceback.format_exc())
     
     except Exception as e:
         st.error(f"Error reading file: {str(e)}")
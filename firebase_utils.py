@@ -1,22 +1,98 @@
-import firebase_admin
-from firebase_admin import credentials, firestore, storage as admin_storage
 import os
-import json
+import mimetypes
 import numpy as np
 import pandas as pd
 from pathlib import Path
 import uuid
-import tempfile
+import functools
+import itertools
+import zlib
+from io import BytesIO
+import threading
+import time
+from urllib.parse import quote
+from concurrent.futures import Future, ThreadPoolExecutor
 import streamlit as st
 
+__all__ = [
+    'initialize_firebase',
+    'get_db',
+    'get_db_and_bucket',
+    'upload_image_to_storage',
+    'upload_minutiae_to_storage',
+    'upload_many_to_firebase',
+    'upload_to_firebase',
+    'invalidate_reference_cache',
+    'match_minutiae_with_database',
+    'calculate_similarity'
+]
+
 # Global variables
 db = None
 bucket = None
 
+# Maximum number of writes Firestore accepts in a single batch
+FIRESTORE_BATCH_SIZE = 500
+
+# Seconds before the cached reference fingerprints are refreshed from Firestore
+REFERENCE_CACHE_TTL = 300
+
+# Reference fingerprints keyed by document id, and when they were last synced, per match scope
+_REF_CACHE = {}
+_REF_LAST_SYNC = {}
+_REF_CACHE_LOCK = threading.Lock()
+
+# Number of Firestore clients, each with its own gRPC channel, handed out round-robin
+FIRESTORE_POOL_SIZE = 4
+
+# Serializes Firebase initialization across Streamlit sessions
+_INIT_LOCK = threading.Lock()
+
+# Point matching kernel, compiled once by _compiled_match_kernel
+_MATCH_KERNEL = None
+_MATCH_KERNEL_LOCK = threading.Lock()
+
+# Worker threads shared by all matches for scoring references in parallel
+_MATCH_POOL = ThreadPoolExecutor(max_workers=8, thread_name_prefix="minutiae-match")
+
+# Point matching thresholds
+PROXIMITY_THRESHOLD = 5  # Distance threshold
+ANGLE_THRESHOLD = 0.3    # Angle threshold in radians (about 17 degrees)
+
+# Score at which a match counts as perfect
+PERFECT_MATCH_SCORE = 99
+
+# Highest possible score, and how many references reaching it to look for before stopping
+FULL_MATCH_SCORE = 100
+MAX_FULL_MATCHES = 10
+
+# Keys a minutia field can be stored under: string numeric, integer or named
+_MINUTIA_KEYS = (('0', 0, 'x'), ('1', 1, 'y'), ('2', 2, 'type'), ('3', 3, 'angle'))
+
+# Text type labels (e.g. 'ending') are hashed to codes from here up, above the numeric uint8 types
+TYPE_LABEL_CODE_BASE = 256
+
+# Angles are quantized into uint8 bins around the circle
+ANGLE_BINS = 256
+ANGLE_BIN_WIDTH = 2 * np.pi / ANGLE_BINS
+ANGLE_BIN_THRESHOLD = int(round(ANGLE_THRESHOLD / ANGLE_BIN_WIDTH))
+
+# Format version of the prepared minutiae blobs; older blobs are ignored
+MINUTIAE_BLOB_VERSION = 2
+
 def initialize_firebase():
     """Initialize Firebase with service account credentials"""
+    # Only one session may create the Firebase app at a time
+    with _INIT_LOCK:
+        return _initialize_firebase()
+
+def _initialize_firebase():
     global db, bucket
     
+    # firebase_admin is only imported once Firebase is first needed
+    import firebase_admin
+    from firebase_admin import credentials, firestore, storage as admin_storage
+    
     # If Firebase is already initialized, get the existing app and clients
     if firebase_admin._apps:
         try:
@@ -37,21 +113,15 @@ def initialize_firebase():
     try:
         # Check if running on Streamlit Cloud (look for secrets)
         if hasattr(st, "secrets") and "firebase" in st.secrets:
-            # Create a temporary JSON file with the secret credentials
-            with tempfile.NamedTemporaryFile(mode='w', suffix='.json', delete=False) as temp:
-                # Write the credentials to the temp file
-                cred_dict = dict(st.secrets["firebase"])
-    
-                # Make sure private_key is properly formatted
-                if "private_key" in cred_dict and isinstance(cred_dict["private_key"], str):
-                    # Ensure the private key has proper newline characters
-                    cred_dict["private_key"] = cred_dict["private_key"].replace("\\n", "\n")
-    
-                json.dump(cred_dict, temp)
-                temp_path = temp.name
+            # Build the credentials straight from the secret dictionary
+            cred_dict = dict(st.secrets["firebase"])
             
-            # Use the temporary file for Firebase initialization
-            cred = credentials.Certificate(temp_path)
+            # Make sure private_key is properly formatted
+            if "private_key" in cred_dict and isinstance(cred_dict["private_key"], str):
+                # Ensure the private key has proper newline characters
+                cred_dict["private_key"] = cred_dict["private_key"].replace("\\n", "\n")
+            
+            cred = credentials.Certificate(cred_dict)
             project_id = cred_dict.get("project_id", "fingerprint-matcher")
             storage_bucket = f"{project_id}.firebasestorage.app"
             
@@ -63,9 +133,6 @@ def initialize_firebase():
                 'storageBucket': storage_bucket
             })
             
-            # Delete the temporary file
-            os.unlink(temp_path)
-            
         else:
             # Use local credentials file
             service_account_path = os.environ.get('GOOGLE_APPLICATION_CREDENTIALS', 'serviceAccountKey.json')
@@ -108,15 +175,33 @@ def initialize_firebase():
     
     return db, bucket
 
-# Rest of your firebase_utils.py code remains the same
-# ...
+@functools.lru_cache(maxsize=1)
+def _clients():
+    """Initialize Firebase once and return the shared (db, bucket) clients"""
+    return initialize_firebase()
+
+@functools.lru_cache(maxsize=1)
+def _db_pool():
+    """Create the Firestore client pool once, starting with the client from initialization"""
+    import firebase_admin
+    from firebase_admin import firestore
+    
+    db, bucket = _clients()
+    app = firebase_admin.get_app()
+    pool = [db] + [
+        firestore.Client(project=app.project_id, credentials=app.credential.get_credential(),
+                         database="fingerprint-data")
+        for _ in range(FIRESTORE_POOL_SIZE - 1)
+    ]
+    return itertools.cycle(pool)
+
+def get_db():
+    """Get the next Firestore client from the pool, initializing if necessary"""
+    return next(_db_pool())
 
 def get_db_and_bucket():
-    """Get the Firestore database and Storage bucket clients, initializing if necessary"""
-    global db, bucket
-    if db is None or bucket is None:
-        db, bucket = initialize_firebase()
-    return db, bucket
+    """Get a pooled Firestore client and the Storage bucket client, initializing if necessary"""
+    return get_db(), _clients()[1]
 
 def upload_image_to_storage(image_file, fingerprint_id):
     """
@@ -127,7 +212,7 @@ def upload_image_to_storage(image_file, fingerprint_id):
         fingerprint_id: ID to use for the image filename
         
     Returns:
-        str: Public URL of the uploaded image
+        str: Download URL of the uploaded image
     """
     try:
         db, bucket = get_db_and_bucket()
@@ -136,29 +221,23 @@ def upload_image_to_storage(image_file, fingerprint_id):
         file_extension = os.path.splitext(image_file.name)[1].lower()
         storage_path = f"fingerprints/{fingerprint_id}{file_extension}"
         
-        # Create a temporary file
-        with tempfile.NamedTemporaryFile(delete=False, suffix=file_extension) as tmp_file:
-            # Write the uploaded file to the temporary file
-            tmp_file.write(image_file.getvalue())
-            tmp_file_path = tmp_file.name
+        # Upload the in-memory file contents directly to Firebase Storage
+        content_type = (getattr(image_file, 'type', None)
+                        or mimetypes.guess_type(image_file.name)[0]
+                        or 'application/octet-stream')
+        # A Firebase download token is set with the upload, instead of a separate
+        # request to make the file public; the token URL doesn't expire
+        download_token = str(uuid.uuid4())
+        blob = bucket.blob(storage_path)
+        blob.metadata = {'firebaseStorageDownloadTokens': download_token}
+        blob.upload_from_string(image_file.getvalue(), content_type=content_type)
         
-        try:
-            # Upload the file to Firebase Storage
-            blob = bucket.blob(storage_path)
-            blob.upload_from_filename(tmp_file_path)
-            
-            # Make the file publicly accessible
-            blob.make_public()
-            
-            # Get the public URL
-            image_url = blob.public_url
-            
-            print(f"Image uploaded successfully to {storage_path}")
-            return image_url
-        finally:
-            # Clean up the temporary file
-            if os.path.exists(tmp_file_path):
-                os.unlink(tmp_file_path)
+        # Build the download URL locally
+        image_url = (f"https://firebasestorage.googleapis.com/v0/b/{bucket.name}/o/"
+                     f"{quote(storage_path, safe='')}?alt=media&token={download_token}")
+        
+        print(f"Image uploaded successfully to {storage_path}")
+        return image_url
         
     except Exception as e:
         print(f"Error uploading image to storage: {e}")
@@ -166,40 +245,139 @@ def upload_image_to_storage(image_file, fingerprint_id):
         print(traceback.format_exc())
         return None
 
-def upload_to_firebase(reference_data, image_file=None):
+def _minutiae_blob_path(doc_id):
+    """Storage path of the prepared minutiae blob of a reference document"""
+    return f"minutiae/{doc_id}.npz"
+
+def upload_minutiae_to_storage(minutiae, doc_id, update_time):
     """
-    Upload reference data and optionally an image to Firebase
+    Upload prepared reference minutiae to Firebase Storage as a compressed .npz blob
+    
+    Args:
+        minutiae (list): List of dictionaries containing reference minutiae data
+        doc_id: ID of the reference document the minutiae belong to
+        update_time: Update time of the document version holding these minutiae
+        
+    Returns:
+        str: Storage path of the uploaded blob
+    """
+    try:
+        db, bucket = get_db_and_bucket()
+        
+        # Serialize the quantized arrays used for matching, stamped with the document version
+        buffer = BytesIO()
+        np.savez_compressed(buffer, version=MINUTIAE_BLOB_VERSION, updateTime=update_time.rfc3339(),
+                            **_prepare_reference(minutiae))
+        
+        storage_path = _minutiae_blob_path(doc_id)
+        bucket.blob(storage_path).upload_from_string(buffer.getvalue(), content_type='application/octet-stream')
+        
+        print(f"Minutiae uploaded successfully to {storage_path}")
+        return storage_path
+        
+    except Exception as e:
+        print(f"Error uploading minutiae to storage: {e}")
+        import traceback
+        print(traceback.format_exc())
+        return None
+
+def _load_minutiae_blob(bucket, storage_path, update_time):
+    """
+    Download prepared minutiae saved by upload_minutiae_to_storage
+    
+    The blob is only used if it was prepared from the document version with the
+    given update time; any later edit to the document falls back to its minutiae field.
+    
+    Returns:
+        dict: Prepared minutiae, or None if the blob is missing or outdated
+    """
+    try:
+        with np.load(BytesIO(bucket.blob(storage_path).download_as_bytes())) as blob:
+            if int(blob['version']) != MINUTIAE_BLOB_VERSION or str(blob['updateTime']) != update_time.rfc3339():
+                return None
+            prepared = {key: blob[key] for key in ('index', 'xy', 'types', 'angles')}
+            prepared['count'] = int(blob['count'])
+        return prepared
+    except Exception as e:
+        print(f"Error loading minutiae blob {storage_path}: {e}")
+        return None
+
+def _prepare_reference_upload(reference_data, image_file=None):
+    """
+    Assign a fingerprint ID to reference data and upload its image, if any
     
     Args:
         reference_data (dict): Reference data to upload
         image_file: Optional image file to upload
         
+    Returns:
+        dict: The reference data, ready to be written to Firestore
+    """
+    # Generate a fingerprint ID if not provided
+    if 'assignmentData' in reference_data and not reference_data['assignmentData'].get('fingerprintId'):
+        fingerprint_id = f"FP{uuid.uuid4().hex[:8].upper()}"
+        reference_data['assignmentData']['fingerprintId'] = fingerprint_id
+    else:
+        fingerprint_id = reference_data['assignmentData'].get('fingerprintId')
+    
+    # Upload image if provided
+    if image_file is not None:
+        image_url = upload_image_to_storage(image_file, fingerprint_id)
+        if image_url:
+            # Add image URL to reference data
+            if 'assignmentData' not in reference_data:
+                reference_data['assignmentData'] = {}
+            reference_data['assignmentData']['imageUrl'] = image_url
+    
+    return reference_data
+
+def upload_many_to_firebase(items, batch_size=FIRESTORE_BATCH_SIZE):
+    """
+    Upload several references, each with an optional image, to Firebase
+    
+    Images are uploaded in parallel and the documents are written in batched commits.
+    The prepared minutiae of each document are then stored alongside as a blob.
+    
+    Args:
+        items (list): List of (reference_data, image_file) tuples, image_file may be None
+        batch_size (int): Maximum number of documents per Firestore batch
+        
     Returns:
         bool: True if successful, False otherwise
     """
     try:
         db, bucket = get_db_and_bucket()
         
-        # Generate a fingerprint ID if not provided
-        if 'assignmentData' in reference_data and not reference_data['assignmentData'].get('fingerprintId'):
-            fingerprint_id = f"FP{uuid.uuid4().hex[:8].upper()}"
-            reference_data['assignmentData']['fingerprintId'] = fingerprint_id
-        else:
-            fingerprint_id = reference_data['assignmentData'].get('fingerprintId')
-        
-        # Upload image if provided
-        if image_file is not None:
-            image_url = upload_image_to_storage(image_file, fingerprint_id)
-            if image_url:
-                # Add image URL to reference data
-                if 'assignmentData' not in reference_data:
-                    reference_data['assignmentData'] = {}
-                reference_data['assignmentData']['imageUrl'] = image_url
-        
-        # Add to the fingerprintReferences collection
-        doc_ref = db.collection('fingerprintReferences').add(reference_data)
+        # Assign fingerprint IDs and upload the images in parallel
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            documents = list(executor.map(lambda item: _prepare_reference_upload(*item), items))
+        
+        # Name the minutiae blobs after the documents they belong to
+        collection = db.collection('fingerprintReferences')
+        doc_refs = [collection.document() for _ in documents]
+        for doc_ref, document in zip(doc_refs, documents):
+            if document.get('minutiae'):
+                document['minutiaeBlob'] = _minutiae_blob_path(doc_ref.id)
+        
+        # Add to the fingerprintReferences collection, one batch per batch_size documents
+        write_results = []
+        for start in range(0, len(documents), batch_size):
+            batch = db.batch()
+            for doc_ref, document in zip(doc_refs[start:start + batch_size], documents[start:start + batch_size]):
+                batch.create(doc_ref, document)
+            write_results.extend(batch.commit())
+        invalidate_reference_cache()
+        
+        # Store the prepared minutiae, stamped with the version of the document just written
+        blobs = [
+            (document['minutiae'], doc_ref.id, write_result.update_time)
+            for doc_ref, document, write_result in zip(doc_refs, documents, write_results)
+            if document.get('minutiae')
+        ]
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            list(executor.map(lambda blob: upload_minutiae_to_storage(*blob), blobs))
         
-        print(f"Data uploaded successfully to fingerprintReferences collection")
+        print(f"{len(documents)} references uploaded successfully to fingerprintReferences collection")
         return True
     except Exception as e:
         print(f"Error uploading to Firebase: {e}")
@@ -207,15 +385,202 @@ def upload_to_firebase(reference_data, image_file=None):
         print(traceback.format_exc())
         return False
 
-def match_minutiae_with_database(minutiae_df):
+def upload_to_firebase(reference_data, image_file=None):
+    """
+    Upload reference data and optionally an image to Firebase
+    
+    Args:
+        reference_data (dict): Reference data to upload
+        image_file: Optional image file to upload
+        
+    Returns:
+        bool: True if successful, False otherwise
+    """
+    return upload_many_to_firebase([(reference_data, image_file)])
+
+def _reference_from_doc(doc, bucket):
+    """
+    Build a reference dataset entry from a Firestore document
+    
+    The document only needs the minutiaeBlob and studentInfo.id fields. The prepared
+    minutiae are loaded from the blob; without a usable blob 'reference' is left as
+    None for _load_document_minutiae to fill in. matchData is left empty until the
+    reference turns up in a match result.
+    """
+    data = doc.to_dict()
+    if 'studentInfo' in data and 'id' in data['studentInfo']:
+        srn = data['studentInfo']['id']
+    else:
+        srn = "Unknown"
+    
+    reference = None
+    if data.get('minutiaeBlob'):
+        reference = _load_minutiae_blob(bucket, data['minutiaeBlob'], doc.update_time)
+    
+    return {
+        'id': doc.id,
+        'srn': srn,
+        'updateTime': doc.update_time,
+        'reference': reference,
+        'matchData': None
+    }
+
+def _load_document_minutiae(db, entries):
+    """
+    Prepare the minutiae of reference entries from their documents' minutiae field
+    
+    Args:
+        db: Firestore client
+        entries (list): Reference dataset entries without prepared minutiae
+    """
+    by_id = {entry['id']: entry for entry in entries}
+    doc_ids = list(by_id)
+    collection = db.collection('fingerprintReferences')
+    
+    # Fetch the documents in batches, preparing them on the worker pool
+    for start in range(0, len(doc_ids), FIRESTORE_BATCH_SIZE):
+        doc_refs = [collection.document(doc_id) for doc_id in doc_ids[start:start + FIRESTORE_BATCH_SIZE]]
+        prepared = [
+            (doc.id, _MATCH_POOL.submit(_prepare_reference, (doc.to_dict() or {}).get('minutiae', [])))
+            for doc in db.get_all(doc_refs, field_paths=['minutiae'])
+        ]
+        for doc_id, future in prepared:
+            by_id[doc_id]['reference'] = future.result()
+    
+    # Documents deleted in the meantime have no minutiae to match against
+    for entry in entries:
+        if entry['reference'] is None:
+            entry['reference'] = _prepare_reference([])
+
+def _attach_match_data(db, matches, references):
+    """
+    Fill in the matchData of matches, fetching full documents for references that lack it
+    
+    Args:
+        db: Firestore client
+        matches (list): Match dictionaries to fill in
+        references (dict): Reference dataset entries keyed by document id
+    """
+    missing = list({match['id'] for match in matches if references[match['id']]['matchData'] is None})
+    collection = db.collection('fingerprintReferences')
+    
+    # Fetch the missing documents in batches
+    for start in range(0, len(missing), FIRESTORE_BATCH_SIZE):
+        doc_refs = [collection.document(doc_id) for doc_id in missing[start:start + FIRESTORE_BATCH_SIZE]]
+        for doc in db.get_all(doc_refs, field_paths=['studentInfo', 'assignmentData']):
+            data = doc.to_dict() or {}
+            references[doc.id]['matchData'] = {
+                'studentInfo': data.get('studentInfo'),
+                'assignmentData': data.get('assignmentData')
+            }
+    
+    for match in matches:
+        match['matchData'] = references[match['id']]['matchData']
+
+def _load_references(db, bucket, scope=None):
+    """
+    Get the reference fingerprints, refreshing the local cache from Firestore when it is stale
+    
+    Args:
+        db: Firestore client
+        bucket: Storage bucket holding the prepared minutiae blobs
+        scope (dict): Optional field values the references must have, e.g.
+            {'assignmentData.class': 'whorl'}; each scope is cached separately
+        
+    Returns:
+        list: Reference dataset entries with prepared minutiae
+    """
+    scope_key = tuple(sorted(scope.items())) if scope else ()
+    
+    with _REF_CACHE_LOCK:
+        last_sync = _REF_LAST_SYNC.get(scope_key)
+        if last_sync is None or time.monotonic() - last_sync > REFERENCE_CACHE_TTL:
+            query = db.collection('fingerprintReferences')
+            if scope:
+                from google.cloud.firestore_v1.base_query import FieldFilter
+                
+                # Let Firestore filter the references down to the requested scope
+                for field, value in scope_key:
+                    query = query.where(filter=FieldFilter(field, '==', value))
+            
+            # Only download the fields needed for matching; the minutiae come from Storage
+            references = query.select(['minutiaeBlob', 'studentInfo.id']).stream()
+            
+            # Only reload documents that are new or have changed; deleted ones drop out.
+            # Blobs are downloaded on the worker pool while later documents are still streaming in.
+            cache = _REF_CACHE.get(scope_key, {})
+            synced = {}
+            for doc in references:
+                cached = cache.get(doc.id)
+                if cached is None or cached['updateTime'] != doc.update_time:
+                    cached = _MATCH_POOL.submit(_reference_from_doc, doc, bucket)
+                synced[doc.id] = cached
+            
+            cache = {
+                doc_id: entry.result() if isinstance(entry, Future) else entry
+                for doc_id, entry in synced.items()
+            }
+            
+            # References uploaded without a minutiae blob are prepared from their documents
+            _load_document_minutiae(db, [entry for entry in cache.values() if entry['reference'] is None])
+            _REF_CACHE[scope_key] = cache
+            _REF_LAST_SYNC[scope_key] = time.monotonic()
+            print(f"Synced {len(cache)} reference fingerprints from Firestore")
+        
+        return list(_REF_CACHE[scope_key].values())
+
+def invalidate_reference_cache():
+    """Force the next match to re-read the reference fingerprints from Firestore"""
+    with _REF_CACHE_LOCK:
+        _REF_LAST_SYNC.clear()
+
+def _score_reference(ref_data, all_test_minutiae):
+    """
+    Match every column arrangement of the uploaded minutiae against one reference
+    
+    Args:
+        ref_data (dict): Reference dataset entry
+        all_test_minutiae (list): Uploaded minutiae arrays, one per column arrangement
+        
+    Returns:
+        dict: Best match for this reference, or None if no arrangement matched any point
+    """
+    best_match_data = None
+    best_match_score = 0
+    
+    for i, test_minutiae in enumerate(all_test_minutiae):
+        # Try matching with this arrangement
+        similarity = _similarity(test_minutiae, ref_data['reference'], ref_data["srn"])
+        
+        # Update best match if better
+        if similarity['score'] > best_match_score:
+            best_match_score = similarity['score']
+            best_match_data = {
+                'id': ref_data['id'],
+                'srn': ref_data['srn'],
+                'matchData': ref_data['matchData'],
+                'similarity': similarity,
+                'arrangement_used': i
+            }
+        
+        # No other arrangement can do better once every point matches
+        if best_match_score >= FULL_MATCH_SCORE:
+            break
+    
+    return best_match_data
+
+def match_minutiae_with_database(minutiae_df, scope=None):
     """
     Match the uploaded minutiae with reference data in the database
     
     Args:
         minutiae_df (pandas.DataFrame): DataFrame with minutiae data
+        scope (dict): Optional field values to restrict the references to, e.g.
+            {'assignmentData.class': 'whorl'}; filtered server-side by Firestore
         
     Returns:
-        dict: Match result or None if no match found
+        dict: Match result or None if no match found; database errors are
+        logged and raised so callers can tell them apart from no match
     """
     try:
         db, bucket = get_db_and_bucket()
@@ -223,96 +588,72 @@ def match_minutiae_with_database(minutiae_df):
         # Try multiple column arrangements to find the best match
         all_matches = []
         
-        # Different column arrangements to try
-        arrangements = [
-            # Default: x, y, type, angle
-            {'x': 0, 'y': 1, 'type': 2, 'angle': 3},
-            # x, y, angle, type
-            {'x': 0, 'y': 1, 'angle': 2, 'type': 3},
-            # type, x, y, angle
-            {'type': 0, 'x': 1, 'y': 2, 'angle': 3},
-            # angle, x, y, type
-            {'angle': 0, 'x': 1, 'y': 2, 'type': 3}
-        ]
+        # Different column arrangements to try, as the columns holding x, y, type and angle
+        arrangements = np.array([
+            [0, 1, 2, 3],  # Default: x, y, type, angle
+            [0, 1, 3, 2],  # x, y, angle, type
+            [1, 2, 0, 3],  # type, x, y, angle
+            [1, 2, 3, 0]   # angle, x, y, type
+        ])
         
-        # Get all reference data from Firestore
-        references = db.collection('fingerprintReferences').get()
+        # Get all reference data in scope, from the local cache when it is fresh
+        reference_dataset = _load_references(db, bucket, scope)
         
-        if not references:
+        if not reference_dataset:
             print("No references found in fingerprintReferences collection")
             return None
         
-        # Prepare reference dataset
-        reference_dataset = []
-        for doc in references:
-            data = doc.to_dict()
-            if 'studentInfo' in data and 'id' in data['studentInfo']:
-                srn = data['studentInfo']['id']
-            else:
-                srn = "Unknown"
-                
-            reference_dataset.append({
-                'id': doc.id,
-                'srn': srn,
-                'minutiae': data.get('minutiae', []),
-                'matchData': {
-                    'studentInfo': data.get('studentInfo'),
-                    'assignmentData': data.get('assignmentData')
-                }
-            })
-        
         print(f"Found {len(reference_dataset)} reference fingerprints in database")
         
-        # Process the uploaded minutiae in all formats
-        all_test_minutiae = []
-        for arrange in arrangements:
-            # Map columns according to arrangement
-            mapped_df = pd.DataFrame()
-            for key, col_idx in arrange.items():
-                if col_idx < len(minutiae_df.columns):
-                    mapped_df[key] = minutiae_df.iloc[:, col_idx]
-            
-            # Convert to records
-            test_minutiae = mapped_df.to_dict(orient='records')
-            all_test_minutiae.append(test_minutiae)
-        
-        # For each reference, try all column arrangements
-        for ref_data in reference_dataset:
-            best_match_data = None
-            best_match_score = 0
-            
-            for i, arrange in enumerate(arrangements):
-                # Use the mapped minutiae for this arrangement
-                test_minutiae = all_test_minutiae[i]
-                
-                # Try matching with this arrangement
-                similarity = calculate_similarity(test_minutiae, ref_data['minutiae'], ref_data["srn"])
-                
-                # Update best match if better
-                if similarity['score'] > best_match_score:
-                    best_match_score = similarity['score']
-                    best_match_data = {
-                        'id': ref_data['id'],
-                        'srn': ref_data['srn'],
-                        'matchData': ref_data['matchData'],
-                        'similarity': similarity,
-                        'arrangement_used': i
-                    }
+        # Process the uploaded minutiae in all formats at once. Any column may hold the
+        # types, so each one is also converted as types, with text labels as codes.
+        values = minutiae_df.apply(pd.to_numeric, errors='coerce').to_numpy(dtype=np.float32)
+        type_codes = np.column_stack([_minutia_type_codes(minutiae_df[column]) for column in minutiae_df.columns])
+        if values.shape[1] < 4:
+            # Missing columns default to 0
+            values = np.pad(values, ((0, 0), (0, 4 - values.shape[1])))
+            type_codes = np.pad(type_codes, ((0, 0), (0, 4 - type_codes.shape[1])))
+        
+        # (arrangements, N, 4) array of x, y, type and angle per arrangement, and the type codes per arrangement
+        all_test = values[:, arrangements].transpose(1, 0, 2)
+        all_test_types = type_codes[:, arrangements[:, 2]].T
+        all_test_minutiae = [
+            _prepare_minutiae(test[:, :2], types, test[:, 3])
+            for test, types in zip(all_test, all_test_types)
+        ]
+        
+        # For each reference, try all column arrangements (references are scored in parallel)
+        futures = [_MATCH_POOL.submit(_score_reference, ref_data, all_test_minutiae) for ref_data in reference_dataset]
+        full_count = 0
+        for future in futures:
+            best_match_data = future.result()
             
             # Add best match for this reference to results
             if best_match_data:
                 all_matches.append(best_match_data)
+                if best_match_data['similarity']['score'] >= FULL_MATCH_SCORE:
+                    full_count += 1
+            
+            # Stop scoring once enough references match every point; none scored later can rank above them
+            if full_count >= MAX_FULL_MATCHES:
+                for pending in futures:
+                    pending.cancel()
+                break
         
         # Sort all matches by score
         all_matches.sort(key=lambda x: x['similarity']['score'], reverse=True)
         
         # Find all near-perfect matches (100% or very close)
         threshold = 95  # Adjusted threshold based on test results
-        perfect_threshold = 99  # Threshold for considering a match as "perfect"
+        perfect_threshold = PERFECT_MATCH_SCORE  # Threshold for considering a match as "perfect"
         
         perfect_matches = [match for match in all_matches if match['similarity']['score'] >= perfect_threshold]
         good_matches = [match for match in all_matches if match['similarity']['score'] >= threshold and match['similarity']['score'] < perfect_threshold]
         
+        # Fetch the full documents only for the matches that can be returned
+        _attach_match_data(db, perfect_matches + good_matches + all_matches[:5],
+                           {ref_data['id']: ref_data for ref_data in reference_dataset})
+        
         # If we have any perfect matches, return all of them
         if perfect_matches:
             print(f"Found {len(perfect_matches)} perfect matches!")
@@ -354,134 +695,227 @@ def match_minutiae_with_database(minutiae_df):
         print(f"Error matching minutiae with database: {e}")
         import traceback
         print(traceback.format_exc())
-        return None
+        raise
 
-def calculate_similarity(uploaded_minutiae, reference_minutiae, srn):
+def _minutia_type_codes(column):
     """
-    Calculate similarity between two minutiae datasets
+    Convert minutia types to numbers, giving text labels stable codes
+    
+    Numeric types are kept as they are. Text labels are hashed to codes from
+    TYPE_LABEL_CODE_BASE up, so a label gets the same code in uploads and
+    references and only ever matches the same label.
     
     Args:
-        uploaded_minutiae (list): List of dictionaries containing minutiae data
-        reference_minutiae (list): List of dictionaries containing reference minutiae data
+        column (pandas.Series): Minutia types
+        
+    Returns:
+        numpy.ndarray: Type codes, NaN where there is no type
+    """
+    codes = pd.to_numeric(column, errors='coerce').to_numpy(dtype=np.float64, copy=True)
+    label_codes = np.iinfo(np.uint16).max + 1 - TYPE_LABEL_CODE_BASE
+    for i in np.flatnonzero(np.isnan(codes)):
+        label = column.iloc[i]
+        if isinstance(label, str) and label.strip():
+            codes[i] = TYPE_LABEL_CODE_BASE + zlib.crc32(label.strip().encode('utf-8')) % label_codes
+    return codes
+
+def _to_soa(points):
+    """
+    Convert a list of minutiae dictionaries into arrays
+    
+    Points may use string numeric keys ('0'..'3'), integer keys (0..3) or named
+    keys (x, y, type, angle). Missing fields default to 0, text type labels get
+    codes from _minutia_type_codes and other non-numeric values become NaN, so
+    those points never match.
+    
+    Args:
+        points (list): List of dictionaries containing minutiae data
+        
+    Returns:
+        tuple: (xy, types, angles) arrays of shape (N, 2), (N,) and (N,)
+    """
+    df = pd.DataFrame.from_records(points)
+    
+    fields = []
+    for keys in _MINUTIA_KEYS:
+        values = np.full(len(df), np.nan)
+        found = np.zeros(len(df), dtype=bool)
+        for key in keys:
+            if key in df.columns:
+                take = ~found & df[key].notna().to_numpy()
+                if 'type' in keys:
+                    converted = _minutia_type_codes(df[key])
+                else:
+                    converted = pd.to_numeric(df[key], errors='coerce').to_numpy(dtype=np.float64)
+                values[take] = converted[take]
+                found |= take
+        values[~found] = 0
+        fields.append(values.astype(np.float32))
+    
+    x, y, types, angles = fields
+    return np.column_stack((x, y)), types, angles
+
+def _prepare_minutiae(xy, types, angles):
+    """
+    Quantize minutiae arrays for matching
+    
+    Coordinates are rounded to int16, types to uint16 and angles to uint8 bins
+    around the circle. Points that can never match (missing or out of range
+    values) are left out, but still count towards the total number of points.
+    
+    Args:
+        xy (numpy.ndarray): Array of shape (N, 2) with x and y coordinates
+        types (numpy.ndarray): Minutia types, with text labels already converted to codes
+        angles (numpy.ndarray): Minutia angles in radians
+        
+    Returns:
+        dict: Point count, original row index and quantized xy, types and angles
+    """
+    xy = np.rint(xy)
+    types = np.rint(types)
+    valid = (
+        np.isfinite(xy).all(axis=1)
+        & (np.abs(xy) <= np.iinfo(np.int16).max).all(axis=1)
+        & np.isfinite(types) & (types >= 0) & (types <= np.iinfo(np.uint16).max)
+        & np.isfinite(angles)
+    )
+    index = np.flatnonzero(valid)
+    angle_bins = np.rint(np.mod(angles[index], 2 * np.pi) / ANGLE_BIN_WIDTH).astype(np.int32) % ANGLE_BINS
+    
+    return {
+        'count': len(xy),
+        'index': index,
+        'xy': xy[index].astype(np.int16),
+        'types': types[index].astype(np.uint16),
+        'angles': angle_bins.astype(np.uint8)
+    }
+
+def _prepare_reference(points):
+    """
+    Convert reference minutiae into quantized arrays
+    
+    Args:
+        points (list): List of dictionaries containing reference minutiae data
+        
+    Returns:
+        dict: Prepared minutiae from _prepare_minutiae
+    """
+    return _prepare_minutiae(*_to_soa(points))
+
+def _match_kernel(test_xy, test_types, test_angles, ref_xy, ref_types, ref_angles):
+    """Point matcher compiled by _compiled_match_kernel, streams through the reference points for each test point"""
+    n_test = test_xy.shape[0]
+    best_ref = np.full(n_test, -1, dtype=np.intp)
+    best_dist2 = np.zeros(n_test, dtype=np.int32)
+    best_angle_diff = np.zeros(n_test, dtype=np.uint8)
+    max_dist2 = PROXIMITY_THRESHOLD * PROXIMITY_THRESHOLD
+    
+    for i in range(n_test):
+        test_x = np.int32(test_xy[i, 0])
+        test_y = np.int32(test_xy[i, 1])
+        test_angle = np.int32(test_angles[i])
+        closest = max_dist2 + 1
+        
+        for j in range(ref_xy.shape[0]):
+            if test_types[i] != ref_types[j]:
+                continue
+            
+            # Squared distance, skipping points no closer than the best so far
+            dx = test_x - np.int32(ref_xy[j, 0])
+            dy = test_y - np.int32(ref_xy[j, 1])
+            dist2 = dx * dx + dy * dy
+            if dist2 >= closest:
+                continue
+            
+            # Angle difference in bins, wrapped into [-ANGLE_BINS/2, ANGLE_BINS/2) without branching
+            angle_diff = abs(((test_angle - np.int32(ref_angles[j]) + ANGLE_BINS // 2) & (ANGLE_BINS - 1)) - ANGLE_BINS // 2)
+            if angle_diff > ANGLE_BIN_THRESHOLD:
+                continue
+            
+            closest = dist2
+            best_ref[i] = j
+            best_dist2[i] = dist2
+            best_angle_diff[i] = angle_diff
+    
+    return best_ref, best_dist2, best_angle_diff
+
+def _compiled_match_kernel():
+    """Compile _match_kernel once, so importing this module does not load numba"""
+    global _MATCH_KERNEL
+    
+    # Only one thread compiles; match workers arriving meanwhile wait for it
+    if _MATCH_KERNEL is None:
+        with _MATCH_KERNEL_LOCK:
+            if _MATCH_KERNEL is None:
+                import numba
+                _MATCH_KERNEL = numba.njit(
+                    "Tuple((intp[::1], int32[::1], uint8[::1]))(int16[:, :], uint16[:], uint8[:], int16[:, :], uint16[:], uint8[:])",
+                    nogil=True, cache=True
+                )(_match_kernel)
+    return _MATCH_KERNEL
+
+def _match_points(test, ref):
+    """
+    Find the closest matching reference point for every test point
+    
+    Args:
+        test (dict): Prepared uploaded minutiae from _prepare_minutiae
+        ref (dict): Prepared reference minutiae from _prepare_reference
+        
+    Returns:
+        tuple: (best_ref, dist2, angle_diff) arrays over the prepared test points,
+        with best_ref set to -1 for test points without a match
+    """
+    return _compiled_match_kernel()(test['xy'], test['types'], test['angles'],
+                                    ref['xy'], ref['types'], ref['angles'])
+
+def _similarity(uploaded, reference, srn):
+    """
+    Calculate similarity between prepared uploaded minutiae and a prepared reference
+    
+    Args:
+        uploaded (dict): Prepared uploaded minutiae from _prepare_minutiae
+        reference (dict): Prepared reference minutiae from _prepare_reference
         srn: Student ID for logging purposes
         
     Returns:
         dict: Similarity score and match details
     """
+    n_uploaded = uploaded['count']
+    n_reference = reference['count']
+    
     # Print summary
-    print(f"Comparing {len(uploaded_minutiae)} uploaded points with {len(reference_minutiae)} reference points of student with srn {srn}")
+    print(f"Comparing {n_uploaded} uploaded points with {n_reference} reference points of student with srn {srn}")
     
     # Early check for empty sets
-    if len(uploaded_minutiae) == 0 or len(reference_minutiae) == 0:
+    if n_uploaded == 0 or n_reference == 0:
         return {
             'score': 0,
             'matchedPoints': 0,
-            'totalPoints': max(len(uploaded_minutiae), len(reference_minutiae)),
+            'totalPoints': max(n_uploaded, n_reference),
             'matchDetails': []
         }
     
-    # Convert all reference minutiae to use consistent keys
-    normalized_reference = []
-    for point in reference_minutiae:
-        normalized_point = {}
-        
-        # Try different key formats
-        if '0' in point:  # String numeric keys
-            normalized_point['x'] = float(point.get('0', 0))
-            normalized_point['y'] = float(point.get('1', 0))
-            normalized_point['type'] = point.get('2', 0)
-            normalized_point['angle'] = float(point.get('3', 0))
-        elif 0 in point:  # Integer keys
-            normalized_point['x'] = float(point.get(0, 0))
-            normalized_point['y'] = float(point.get(1, 0))
-            normalized_point['type'] = point.get(2, 0)
-            normalized_point['angle'] = float(point.get(3, 0))
-        else:  # Already has named keys
-            normalized_point['x'] = float(point.get('x', 0))
-            normalized_point['y'] = float(point.get('y', 0))
-            normalized_point['type'] = point.get('type', 0)
-            normalized_point['angle'] = float(point.get('angle', 0))
-        
-        normalized_reference.append(normalized_point)
-    
-    # Convert all uploaded minutiae to use consistent keys
-    normalized_uploaded = []
-    for point in uploaded_minutiae:
-        normalized_point = {}
-        
-        # All uploads should have named keys already, but just in case
-        normalized_point['x'] = float(point.get('x', 0))
-        normalized_point['y'] = float(point.get('y', 0))
-        normalized_point['type'] = point.get('type', 0)
-        normalized_point['angle'] = float(point.get('angle', 0))
-        
-        normalized_uploaded.append(normalized_point)
-    
     # Match points
-    matches = 0
+    best_ref, dist2, angle_diff = _match_points(uploaded, reference)
+    matched_idx = np.flatnonzero(best_ref >= 0)
+    matches = len(matched_idx)
+    
+    # Include first 10 match details for debugging
     match_details = []
-    proximity_threshold = 5  # Distance threshold
-    angle_threshold = 0.3    # Angle threshold in radians (about 17 degrees)
-    
-    for i, test_point in enumerate(normalized_uploaded):
-        best_match_dist = float('inf')
-        best_match_detail = None
-        
-        for j, ref_point in enumerate(normalized_reference):
-            try:
-                # Extract coordinates (already converted to float above)
-                test_x = test_point['x']
-                test_y = test_point['y']
-                test_type = test_point['type']
-                test_angle = test_point['angle']
-                
-                ref_x = ref_point['x']
-                ref_y = ref_point['y']
-                ref_type = ref_point['type']
-                ref_angle = ref_point['angle']
-                
-                # Normalize types - convert strings to numbers if needed
-                if isinstance(test_type, str) and test_type.isdigit():
-                    test_type = int(test_type)
-                if isinstance(ref_type, str) and ref_type.isdigit():
-                    ref_type = int(ref_type)
-                
-                # Calculate distance
-                distance = np.sqrt((test_x - ref_x)**2 + (test_y - ref_y)**2)
-                
-                # Calculate angle difference (handling circular nature)
-                angle_diff = min(
-                    abs(test_angle - ref_angle),
-                    2 * np.pi - abs(test_angle - ref_angle)
-                )
-                
-                # Type matching
-                type_match = test_type == ref_type
-                
-                # Check if points match
-                if distance <= proximity_threshold and angle_diff <= angle_threshold and type_match:
-                    # Find the best (closest) match for this test point
-                    if distance < best_match_dist:
-                        best_match_dist = distance
-                        best_match_detail = {
-                            'test_idx': i,
-                            'ref_idx': j,
-                            'distance': float(distance),
-                            'angle_diff': float(angle_diff),
-                            'test_coords': (float(test_x), float(test_y)),
-                            'ref_coords': (float(ref_x), float(ref_y))
-                        }
-            except Exception as e:
-                print(f"Error comparing points {i} and {j}: {e}")
-                continue
-        
-        # If we found a match for this test point, count it
-        if best_match_detail:
-            matches += 1
-            match_details.append(best_match_detail)
+    for i in matched_idx[:10]:
+        j = best_ref[i]
+        match_details.append({
+            'test_idx': int(uploaded['index'][i]),
+            'ref_idx': int(reference['index'][j]),
+            'distance': float(np.sqrt(dist2[i])),
+            'angle_diff': float(angle_diff[i] * ANGLE_BIN_WIDTH),
+            'test_coords': (float(uploaded['xy'][i, 0]), float(uploaded['xy'][i, 1])),
+            'ref_coords': (float(reference['xy'][j, 0]), float(reference['xy'][j, 1]))
+        })
     
     # Calculate similarity score
-    total_points = max(len(normalized_uploaded), len(normalized_reference))
+    total_points = max(n_uploaded, n_reference)
     similarity_score = (matches / total_points) * 100 if total_points > 0 else 0
     
     # Print results summary
@@ -491,5 +925,22 @@ def calculate_similarity(uploaded_minutiae, reference_minutiae, srn):
         'score': similarity_score,
         'matchedPoints': matches,
         'totalPoints': total_points,
-        'matchDetails': match_details[:10] if match_details else []  # Include first 10 match details for debugging
+        'matchDetails': match_details
     }
+
+def calculate_similarity(uploaded_minutiae, reference_minutiae, srn):
+    """
+    Calculate similarity between two minutiae datasets
+    
+    Args:
+        uploaded_minutiae (list): List of dictionaries containing minutiae data
+        reference_minutiae (list): List of dictionaries containing reference minutiae data
+        srn: Student ID for logging purposes
+        
+    Returns:
+        dict: Similarity score and match details
+    """
+    return _similarity(_prepare_minutiae(*_to_soa(uploaded_minutiae)), _prepare_reference(reference_minutiae), srn)
+
+# Compile the matching kernel in the background, off the import and first-match path
+_MATCH_POOL.submit(_compiled_match_kernel)